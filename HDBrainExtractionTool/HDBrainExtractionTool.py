@@ -1,13 +1,25 @@
 import logging
 import os
 
-import vtk
+import qt
 
 import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
 
+# Terminology and color of the brain segment
+_BRAIN_TERMINOLOGY = (
+  "Segmentation category and type - 3D Slicer General Anatomy list"
+  "~SCT^123037004^Anatomical Structure"
+  "~SCT^12738006^Brain"
+  "~^^"
+  "~Anatomic codes - DICOM master list"
+  "~^^"
+  "~^^")
+_BRAIN_COLOR = (0.9803921568627451, 0.9803921568627451, 0.8823529411764706)
+
+
 #
 # HDBrainExtractionTool
 #
@@ -83,11 +95,16 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
 
     # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
-    # (in the selected parameter node).
-    self.ui.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.outputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.outputSegmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.deviceComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    # (in the selected parameter node). Changes are collected for a short time, so that a burst of changes
+    # (e.g., when all selectors are set by a script) results in a single parameter node update.
+    self._updateTimer = qt.QTimer()
+    self._updateTimer.setSingleShot(True)
+    self._updateTimer.setInterval(100)
+    self._updateTimer.connect('timeout()', self.updateParameterNodeFromGUI)
+    self.ui.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.scheduleParameterNodeUpdateFromGUI)
+    self.ui.outputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.scheduleParameterNodeUpdateFromGUI)
+    self.ui.outputSegmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.scheduleParameterNodeUpdateFromGUI)
+    self.ui.deviceComboBox.connect("currentIndexChanged(int)", self.scheduleParameterNodeUpdateFromGUI)
 
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
@@ -99,7 +116,10 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self._updateTimer.stop()
     self.removeObservers()
+    # Free up memory used by the networks
+    self.logic.clearCache()
 
   def enter(self):
     """
@@ -113,7 +133,10 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     Called each time the user opens a different module.
     """
     # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
-    self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+    from vtkmodules.vtkCommonCore import vtkCommand
+    self.removeObserver(self._parameterNode, vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+    # Networks are kept (not released here), as users often switch to another module to review the results
+    # and then come back to process another volume
 
   def onSceneStartClose(self, caller, event):
     """
@@ -137,13 +160,21 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     # Parameter node stores all user choices in parameter values, node selections, etc.
     # so that when the scene is saved and reloaded, these settings are restored.
 
-    self.setParameterNode(self.logic.getParameterNode())
+    parameterNode = self.logic.getParameterNode()
+
+    # Modify all properties in a single batch, so that the GUI is updated only once
+    wasModified = parameterNode.StartModify()
+    try:
+      self.logic.setDefaultParameters(parameterNode)
+      # Select default input nodes if nothing is selected yet to save a few clicks for the user
+      if not parameterNode.GetNodeReference("InputVolume"):
+        firstVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
+        if firstVolumeNode:
+          parameterNode.SetNodeReferenceID("InputVolume", firstVolumeNode.GetID())
+    finally:
+      parameterNode.EndModify(wasModified)
 
-    # Select default input nodes if nothing is selected yet to save a few clicks for the user
-    if not self._parameterNode.GetNodeReference("InputVolume"):
-      firstVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
-      if firstVolumeNode:
-        self._parameterNode.SetNodeReferenceID("InputVolume", firstVolumeNode.GetID())
+    self.setParameterNode(parameterNode)
 
   def setParameterNode(self, inputParameterNode):
     """
@@ -151,17 +182,15 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     Observation is needed because when the parameter node is changed then the GUI must be updated immediately.
     """
 
-    if inputParameterNode:
-      self.logic.setDefaultParameters(inputParameterNode)
-
     # Unobserve previously selected parameter node and add an observer to the newly selected.
     # Changes of parameter node are observed so that whenever parameters are changed by a script or any other module
     # those are reflected immediately in the GUI.
+    from vtkmodules.vtkCommonCore import vtkCommand
     if self._parameterNode is not None:
-      self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+      self.removeObserver(self._parameterNode, vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
     self._parameterNode = inputParameterNode
     if self._parameterNode is not None:
-      self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+      self.addObserver(self._parameterNode, vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
 
     # Initial GUI update
     self.updateGUIFromParameterNode()
@@ -172,21 +201,29 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     The module GUI is updated to show the current state of the parameter node.
     """
 
+    # Discard pending GUI changes, the GUI is updated from the parameter node now
+    self._updateTimer.stop()
+
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
 
     # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
     self._updatingGUIFromParameterNode = True
 
+    # Get all parameters once, as each query has some overhead
+    inputVolume = self._parameterNode.GetNodeReference("InputVolume")
+    outputVolume = self._parameterNode.GetNodeReference("OutputVolume")
+    outputSegmentation = self._parameterNode.GetNodeReference("OutputSegmentation")
+    device = self._parameterNode.GetParameter("Device")
+
     # Update node selectors and sliders
-    self.ui.inputVolumeSelector.setCurrentNode(self._parameterNode.GetNodeReference("InputVolume"))
-    self.ui.outputVolumeSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolume"))
-    self.ui.outputSegmentationSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputSegmentation"))
-    self.ui.deviceComboBox.setCurrentText(self._parameterNode.GetParameter("Device"))
+    self.ui.inputVolumeSelector.setCurrentNode(inputVolume)
+    self.ui.outputVolumeSelector.setCurrentNode(outputVolume)
+    self.ui.outputSegmentationSelector.setCurrentNode(outputSegmentation)
+    self.ui.deviceComboBox.setCurrentText(device)
 
     # Update buttons states and tooltips
-    inputVolume = self._parameterNode.GetNodeReference("InputVolume")
-    if inputVolume and (self._parameterNode.GetNodeReference("OutputVolume") or self._parameterNode.GetNodeReference("OutputSegmentation")):
+    if inputVolume and (outputVolume or outputSegmentation):
       self.ui.applyButton.toolTip = "Extract brain"
       self.ui.applyButton.enabled = True
     else:
@@ -200,6 +237,15 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     # All the GUI updates are done
     self._updatingGUIFromParameterNode = False
 
+  def scheduleParameterNodeUpdateFromGUI(self, *args):
+    """
+    This method is called when the user makes any change in the GUI.
+    The parameter node is updated after a short delay, so that a burst of changes results in a single update.
+    """
+    if self._parameterNode is None or self._updatingGUIFromParameterNode:
+      return
+    self._updateTimer.start()
+
   def updateParameterNodeFromGUI(self, caller=None, event=None):
     """
     This method is called when the user makes any change in the GUI.
@@ -209,14 +255,20 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
 
-    wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
+    parameterNode = self._parameterNode
+    inputVolumeID = self.ui.inputVolumeSelector.currentNodeID
+    outputVolumeID = self.ui.outputVolumeSelector.currentNodeID
+    outputSegmentationID = self.ui.outputSegmentationSelector.currentNodeID
+    device = self.ui.deviceComboBox.currentText
+
+    wasModified = parameterNode.StartModify()  # Modify all properties in a single batch
 
-    self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.inputVolumeSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID("OutputVolume", self.ui.outputVolumeSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID("OutputSegmentation", self.ui.outputSegmentationSelector.currentNodeID)
-    self._parameterNode.SetParameter("Device", self.ui.deviceComboBox.currentText)
+    parameterNode.SetNodeReferenceID("InputVolume", inputVolumeID)
+    parameterNode.SetNodeReferenceID("OutputVolume", outputVolumeID)
+    parameterNode.SetNodeReferenceID("OutputSegmentation", outputSegmentationID)
+    parameterNode.SetParameter("Device", device)
 
-    self._parameterNode.EndModify(wasModified)
+    parameterNode.EndModify(wasModified)
 
   def onApplyButton(self):
     """
@@ -244,6 +296,26 @@ class HDBrainExtractionToolWidget(ScriptedLoadableModuleWidget, VTKObservationMi
 # HDBrainExtractionToolLogic
 #
 
+class CompiledNetworkWithFallback:
+  """Network compiled with torch.compile, which falls back to the original (eager) network if compilation fails.
+  torch.compile is lazy, therefore errors (such as missing Triton or C++ compiler) are only reported when the
+  compiled network is first called with a new input.
+  """
+
+  def __init__(self, compiledNetwork, eagerNetwork):
+    self.compiledNetwork = compiledNetwork
+    self.eagerNetwork = eagerNetwork
+
+  def __call__(self, x):
+    if self.compiledNetwork is not None:
+      try:
+        return self.compiledNetwork(x)
+      except Exception as e:
+        logging.warning(f"Network compilation failed, prediction is computed in eager mode: {e}")
+        self.compiledNetwork = None
+    return self.eagerNetwork(x)
+
+
 class HDBrainExtractionToolLogic(ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
@@ -259,9 +331,16 @@ class HDBrainExtractionToolLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    # Networks with loaded model parameters, for each (mode, device). Dict of {fold: network}.
+    self._networkCache = {}
+    self._requirementsOk = False
 
   def setupPythonRequirements(self):
 
+    if self._requirementsOk:
+      # All requirements have been already installed and found
+      return
+
     # Install PyTorch
     import PyTorchUtils
     torchLogic = PyTorchUtils.PyTorchUtilsLogic()
@@ -271,40 +350,31 @@ class HDBrainExtractionToolLogic(ScriptedLoadableModuleLogic):
       if torch is None:
         raise ValueError('PyTorch extension needs to be installed to use this module.')
 
-    # Install HD-BET
-    needToInstallHdBet = False
-    try:
-      import HD_BET
-    except ModuleNotFoundError as e:
-      needToInstallHdBet = True
-    if needToInstallHdBet:
-      # Download HD-BET repository from github as a zip file
-      tempFolder = slicer.util.tempDirectory()
-      import SampleData
-      dataLogic = SampleData.SampleDataLogic()
-      hdBetZipFilePath = dataLogic.downloadFile('https://github.com/MIC-DKFZ/HD-BET/archive/refs/heads/master.zip', tempFolder, 'HD-BET.zip')
-      # Unzip file
-      slicer.util.extractArchive(hdBetZipFilePath, tempFolder)
-      # Copy HD_BET subfolder to this module's folder so that it can be found as a Python package
-      import shutil
-      import os
-      scriptedModulesPath = os.path.dirname(slicer.util.modulePath(self.moduleName))
-      shutil.move(tempFolder+"/HD-BET-master/HD_BET", scriptedModulesPath+"/HD_BET")
-      import HD_BET
+    # Install HD-BET and batchgenerators.
+    # Missing packages are installed in a single pip call, so that dependencies are resolved only once.
+    # PyTorch is already installed at this point (by PyTorchUtils), so pip keeps that version.
+    import importlib
+    requirements = [
+      # HD-BET version is pinned, because this module uses internals of HD-BET v1
+      # (HD-BET v2 is a complete rewrite, based on nnU-Net, with a different package structure).
+      ("HD_BET", "HD_BET==1.1"),
+      ("batchgenerators", "batchgenerators"),
+      ]
+    missingRequirements = []
+    for moduleName, requirement in requirements:
+      try:
+        importlib.import_module(moduleName)
+      except ModuleNotFoundError as e:
+        missingRequirements.append(requirement)
+    if missingRequirements:
+      slicer.util.pip_install(" ".join(missingRequirements))
 
     # Ensure that the download folder for model files exist
     import os
     import HD_BET.paths
     os.makedirs(HD_BET.paths.folder_with_parameter_files, exist_ok=True)
 
-    # Install batchgenerators
-    needToInstallBatchGenerators = False
-    try:
-      import batchgenerators
-    except ModuleNotFoundError as e:
-      needToInstallBatchGenerators = True
-    if needToInstallBatchGenerators:
-      slicer.util.pip_install('batchgenerators')
+    self._requirementsOk = True
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -343,22 +413,10 @@ class HDBrainExtractionToolLogic(ScriptedLoadableModuleLogic):
         device = "cpu"
 
     import os
-    from HD_BET.run import run_hd_bet
-    from HD_BET.utils import maybe_mkdir_p, subfiles
     import HD_BET
 
-    # Create new empty folder
-    tempFolder = slicer.util.tempDirectory()
-
-    input_file = tempFolder+"/hdbet-input.nii.gz"
-    output_file = tempFolder+"/hdbet-output.nii.gz"
-    output_segmentation_file = tempFolder+"/hdbet-output_mask.nii.gz"
-
-    # Write input volume to file
-    volumeStorageNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
-    volumeStorageNode.SetFileName(input_file)
-    volumeStorageNode.WriteData(inputVolume)
-    volumeStorageNode.UnRegister(None)
+    # Pass input volume to HD-BET in memory (instead of writing it to file)
+    input_image = self.getSimpleITKImageFromVolume(inputVolume)
 
     # Run the algorithm. This section is based on HD_BET\hd-bet script.
     # The mode='fast' and tta=False will disable test time data augmentation (speedup of 8x)
@@ -372,48 +430,322 @@ class HDBrainExtractionToolLogic(ScriptedLoadableModuleLogic):
       # GPU is not available, only do fast, less accurate processing
       mode = 'fast'
       enable_augmentation = False
-    save_mask = outputSegmentation is not None
-    save_masked_volume = outputVolume is not None
     params_file = os.path.join(HD_BET.__path__[0], "model_final.py")
     config_file = os.path.join(HD_BET.__path__[0], "config.py")
-    run_hd_bet([input_file], [output_file], mode, config_file, device, postprocess = True, do_tta = enable_augmentation, keep_mask = save_mask, overwrite = True, bet = save_masked_volume)
+    # Only the mask is computed by HD-BET, the skull-stripped volume is computed here from the mask
+    maskArray = self.runHdBet(input_image, mode, config_file, device, postprocess = True, do_tta = enable_augmentation)
 
-    # Input file is no longer needed
-    os.remove(input_file)
-
-    # Read results from output files
+    # Write results into output nodes directly from memory
 
     if outputVolume:
-      volumeStorageNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
-      volumeStorageNode.SetFileName(output_file)
-      volumeStorageNode.ReadData(outputVolume)
-      volumeStorageNode.UnRegister(None)
-      os.remove(output_file)
+      # Copy the input volume into the output volume and blank out the region outside the brain in-place
+      # (same as HD_BET.run.apply_bet, works for any voxel type and sets non-finite values outside the brain to 0)
+      if outputVolume != inputVolume:
+        outputVolume.CopyOrientation(inputVolume)
+        slicer.util.updateVolumeFromArray(outputVolume, slicer.util.arrayFromVolume(inputVolume))
+      outputArray = slicer.util.arrayFromVolume(outputVolume)
+      outputArray[maskArray == 0] = 0
+      slicer.util.arrayFromVolumeModified(outputVolume)
+      outputVolume.CreateDefaultDisplayNodes()
 
     if outputSegmentation:
-      segmentationStorageNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLSegmentationStorageNode")
-      segmentationStorageNode.SetFileName(output_segmentation_file)
-      segmentationStorageNode.ReadData(outputSegmentation)
-      segmentationStorageNode.UnRegister(None)
-      os.remove(output_segmentation_file)
-
-      # Set segment terminology
-      segmentId = outputSegmentation.GetSegmentation().GetNthSegmentID(0)
-      segment = outputSegmentation.GetSegmentation().GetSegment(segmentId)
-      segment.SetTag(segment.GetTerminologyEntryTagName(),
-        "Segmentation category and type - 3D Slicer General Anatomy list"
-        "~SCT^123037004^Anatomical Structure"
-        "~SCT^12738006^Brain"
-        "~^^"
-        "~Anatomic codes - DICOM master list"
-        "~^^"
-        "~^^")
-      segment.SetName("brain")
-      segment.SetColor(0.9803921568627451, 0.9803921568627451, 0.8823529411764706)
+      # Modify the segmentation in a single batch, to avoid repeated display updates
+      wasModified = outputSegmentation.StartModify()
+      try:
+        segmentation = outputSegmentation.GetSegmentation()
+        segmentation.RemoveAllSegments()
+        outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+        outputSegmentation.CreateDefaultDisplayNodes()
+
+        # Write the mask directly into the brain segment (no segment is created if the mask is empty).
+        # No temporary labelmap volume node is added to the scene, so node selectors are not updated.
+        if maskArray.any():
+          segmentId = segmentation.AddEmptySegment("brain", "brain", _BRAIN_COLOR)
+          segment = segmentation.GetSegment(segmentId)
+          segment.SetTag(segment.GetTerminologyEntryTagName(), _BRAIN_TERMINOLOGY)
+          slicer.util.updateSegmentBinaryLabelmapFromArray(maskArray, outputSegmentation, segmentId, inputVolume)
+        else:
+          logging.warning("Brain mask is empty")
+      finally:
+        outputSegmentation.EndModify(wasModified)
 
     stopTime = time.time()
     logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
 
+  def getSimpleITKImageFromVolume(self, volumeNode):
+    """
+    Create a SimpleITK image from a scalar volume node, without writing it to file.
+    Image geometry is converted to LPS coordinate system, as it is stored in image files.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray(slicer.util.arrayFromVolume(volumeNode))
+    image.SetSpacing(volumeNode.GetSpacing())
+    origin = volumeNode.GetOrigin()
+    image.SetOrigin((-origin[0], -origin[1], origin[2]))
+    ijkToRasDirections = np.zeros([3, 3])
+    volumeNode.GetIJKToRASDirections(ijkToRasDirections)
+    rasToLps = np.diag([-1.0, -1.0, 1.0])
+    image.SetDirection((rasToLps @ ijkToRasDirections).flatten())
+    return image
+
+  def loadAndPreprocess(self, mri_image):
+    """
+    Modified copy of HD_BET.data_loading.load_and_preprocess, which takes a SimpleITK image instead of a filename.
+    """
+    from HD_BET.data_loading import preprocess_image
+
+    properties_dict = {
+      "spacing": mri_image.GetSpacing(),
+      "direction": mri_image.GetDirection(),
+      "size": mri_image.GetSize(),
+      "origin": mri_image.GetOrigin()
+    }
+
+    image = preprocess_image(mri_image, is_seg=False, spacing_target=(1.5, 1.5, 1.5))
+    properties_dict['size_before_cropping'] = image.shape
+
+    all_data = image[None]
+    return all_data, properties_dict
+
+  def getNetworks(self, cf, mode, device):
+    """
+    Get HD-BET networks with model parameters loaded, on the selected device.
+    Networks are compiled using torch.compile (if available) when running on GPU.
+    Loading of model parameters is slow, therefore the networks are kept and reused in subsequent calls,
+    until clearCache() is called. Compilation happens at the first prediction (about 10 seconds for each network).
+    Networks are compiled with dynamic shapes, so that they are not recompiled for each new input volume size.
+    CUDA graphs are not used (default compile mode instead of "reduce-overhead"): the whole volume is processed
+    in a single forward pass, so kernel launch overhead is negligible, while CUDA graphs would keep a memory pool
+    for each input size and prevent running the networks in parallel CUDA streams.
+    :return: dict of {fold: network}
+    """
+    if (mode, device) in self._networkCache:
+      return self._networkCache[(mode, device)]
+
+    import torch
+    from HD_BET.utils import SetNetworkToVal, get_params_fname, maybe_download_parameters
+
+    if mode == 'fast':
+      folds = [0]
+    elif mode == 'accurate':
+      folds = range(5)
+    else:
+      raise ValueError(f"Unknown value for mode: {mode}. Expected: fast or accurate")
+
+    torchDevice = torch.device("cpu") if device == "cpu" else torch.device("cuda", device)
+
+    networks = {}
+    for fold in folds:
+      maybe_download_parameters(fold)
+      net, _ = cf.get_network(cf.val_use_train_mode, None)
+      net.load_state_dict(torch.load(get_params_fname(fold), map_location=torchDevice))
+      net.to(torchDevice)
+      net.eval()
+      net.apply(SetNetworkToVal(False, False))
+      net.requires_grad_(False)
+      if device != "cpu":
+        # Use NDHWC memory layout, which allows cuDNN to use faster convolution kernels
+        net = net.to(memory_format=torch.channels_last_3d)
+
+      # Inductor is not reliable for 3D convolutions on CPU, therefore the network is only compiled for GPU
+      if hasattr(torch, "compile") and device != "cpu":
+        try:
+          net = CompiledNetworkWithFallback(torch.compile(net, fullgraph=False, dynamic=True), net)
+        except RuntimeError as e:
+          logging.warning(f"Network compilation is not available, prediction is computed in eager mode: {e}")
+
+      networks[fold] = net
+
+    self._networkCache[(mode, device)] = networks
+    return networks
+
+  def clearCache(self):
+    """
+    Release all networks that were kept for reuse, to free up (GPU) memory.
+    """
+    self._networkCache.clear()
+    import sys
+    if "torch" in sys.modules:
+      import torch
+      if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+  def predictCase3DNet(self, nets, patient_data, do_mirroring, num_repeats, BATCH_SIZE=None,
+      new_shape_must_be_divisible_by=16, min_size=None, main_device=0, mirror_axes=(2, 3, 4)):
+    """
+    Modified copy of HD_BET.predict_case.predict_case_3D_net, which predicts with an ensemble of networks.
+    The input is transferred to the device only once, mirroring and averaging of predictions is done on the device.
+    On GPU, channels-last memory layout is used for the network input, pinned (page-locked) host memory
+    is used for the data transfer, and the networks are run in parallel in separate CUDA streams.
+    Only the softmax prediction (averaged over all networks and mirrorings) is computed and returned.
+    """
+    import contextlib
+    import numpy as np
+    import torch
+    from HD_BET.predict_case import pad_patient_3D
+
+    # Inference mode has lower overhead than no_grad (available since PyTorch 1.9)
+    inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+    with inference_mode():
+      pad_res = []
+      for i in range(patient_data.shape[0]):
+        t, old_shape = pad_patient_3D(patient_data[i], new_shape_must_be_divisible_by, min_size)
+        pad_res.append(t[None])
+
+      patient_data = np.vstack(pad_res)
+
+      new_shp = patient_data.shape
+
+      data = np.zeros(tuple([1] + list(new_shp)), dtype=np.float32)
+
+      data[0] = patient_data
+
+      if BATCH_SIZE is not None:
+        data = np.vstack([data] * BATCH_SIZE)
+
+      streams = None
+      if main_device == 'cpu':
+        torch_device = torch.device("cpu")
+        a = torch.from_numpy(data)
+      else:
+        torch_device = torch.device("cuda", main_device)
+        # The input is uploaded only once, from pinned (page-locked) host memory, which allows faster,
+        # asynchronous transfer. copy_ keeps the channels-last memory layout of the target tensor.
+        a_host = torch.empty(data.shape, dtype=torch.float32, pin_memory=True)
+        a_host.numpy()[:] = data
+        a = torch.empty(data.shape, dtype=torch.float32, device=torch_device, memory_format=torch.channels_last_3d)
+        _ = a.data.copy_(a_host, non_blocking=True)
+        # Network weights are small, but the feature maps need a lot of memory, therefore
+        # networks are only run in parallel if there is plenty of free GPU memory.
+        # Compiled networks do not use CUDA graphs (see getNetworks), so they can run in separate streams, too.
+        min_free_memory_for_parallel_prediction = 2 * 1024 * 1024 * 1024
+        if len(nets) > 1 and torch.cuda.mem_get_info(torch_device)[0] >= min_free_memory_for_parallel_prediction:
+          current_stream = torch.cuda.current_stream(torch_device)
+          streams = [torch.cuda.Stream(torch_device) for net in nets]
+
+      # Combinations of mirrored axes (the first one is the original, not mirrored data)
+      if do_mirroring:
+        mirror_axes_combinations = [(), (4,), (3,), (3, 4), (2,), (2, 4), (2, 3), (2, 3, 4)]
+        mirror_axes_combinations = [axes for axes in mirror_axes_combinations if all([axis in mirror_axes for axis in axes])]
+      else:
+        mirror_axes_combinations = [()]
+
+      # Mirroring and averaging is done on the device where the prediction is computed.
+      # Each network has its own accumulator, so that each stream only modifies its own data.
+      softmax_sums = [None] * len(nets)
+      number_of_preds = 0
+      for i in range(num_repeats):
+        for axes in mirror_axes_combinations:
+          x = torch.flip(a, axes) if axes else a
+          for net_index, net in enumerate(nets):
+            if streams:
+              # Start prediction when the input is ready
+              streams[net_index].wait_stream(current_stream)
+              # Input is used in another stream, make sure its memory is not reused until that stream is completed
+              x.record_stream(streams[net_index])
+              stream_context = torch.cuda.stream(streams[net_index])
+            else:
+              stream_context = contextlib.nullcontext()
+            with stream_context:
+              p = net(x)
+              if axes:
+                p = torch.flip(p, axes)
+              if softmax_sums[net_index] is None:
+                softmax_sums[net_index] = p.to(torch.float32, copy=True)
+              else:
+                softmax_sums[net_index] += p
+            number_of_preds += p.shape[0]
+
+      if streams:
+        for stream in streams:
+          current_stream.wait_stream(stream)
+      softmax_sum = sum(softmax_sums).sum(0)[:, :old_shape[0], :old_shape[1], :old_shape[2]]
+      # Only the final average is downloaded from the GPU
+      softmax_pred = (softmax_sum / number_of_preds).cpu().numpy()
+    return softmax_pred
+
+  def restoreSegmentationSize(self, segmentation, dct, order=1):
+    """
+    Modified copy of HD_BET.data_loading.save_segmentation_nifti, which returns the segmentation
+    resampled to the original image size as a numpy array instead of writing it to file.
+    """
+    import numpy as np
+    from HD_BET.data_loading import resize_segmentation
+
+    # Cropping to the brain bounding box (brain_bbox) is not used by loadAndPreprocess, so only resampling is needed
+    original_shape = np.array(dct['size'])[[2, 1, 0]]
+    if np.any(np.array(segmentation.shape) != original_shape):
+      segmentation = resize_segmentation(segmentation, original_shape, order=order)
+    return segmentation.astype(np.uint8)
+
+  def postprocessPrediction(self, seg):
+    """
+    Keep only the largest connected component of the segmentation.
+    Same as HD_BET.utils.postprocess_prediction, but size of all components is computed in a single pass
+    over the image (instead of comparing the entire image with each component label).
+    """
+    import numpy as np
+    from skimage.morphology import label
+
+    mask = seg != 0
+    lbls = label(mask, connectivity=mask.ndim)
+    lbls_sizes = np.bincount(lbls.ravel())
+    if len(lbls_sizes) < 2:
+      # Empty segmentation, there is no component to keep
+      return seg
+    largest_region = np.argmax(lbls_sizes[1:]) + 1
+    seg[lbls != largest_region] = 0
+    return seg
+
+  def runHdBet(self, mri_image, mode, config_file, device, postprocess=False, do_tta=True):
+    """
+    Compute brain mask for a single SimpleITK image.
+    This is a modified copy of HD_BET.run.run_hd_bet, which uses networks that are compiled
+    and kept between calls (see getNetworks), and takes the input image and returns the mask in memory.
+    :return: mask as numpy array, with the same voxel grid as the input image
+    """
+    import contextlib
+    import importlib.util
+    import numpy as np
+    import torch
+
+    spec = importlib.util.spec_from_file_location('cf', config_file)
+    cf_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cf_module)
+    cf = cf_module.config()
+
+    # Input size is the same for all predictions, therefore it is worth to let cuDNN find the fastest
+    # convolution algorithm for it. The setting is only changed during the prediction, as it is global
+    # and it could affect other modules that use PyTorch.
+    if device != "cpu":
+      cudnnContext = lambda: torch.backends.cudnn.flags(enabled=torch.backends.cudnn.enabled, benchmark=True,
+        deterministic=torch.backends.cudnn.deterministic, allow_tf32=torch.backends.cudnn.allow_tf32)
+    else:
+      cudnnContext = contextlib.nullcontext
+
+    networks = self.getNetworks(cf, mode, device)
+
+    data, data_dict = self.loadAndPreprocess(mri_image)
+
+    # Compute prediction in half precision on GPUs that have Tensor Cores (Volta or later).
+    # This makes computation about 2x faster, without noticeable change in the segmentation result.
+    if device != "cpu" and torch.cuda.get_device_capability(device)[0] >= 7:
+      precisionContext = lambda: torch.autocast(device_type="cuda", dtype=torch.float16)
+    else:
+      precisionContext = contextlib.nullcontext
+
+    with cudnnContext(), precisionContext():
+      softmax_pred = self.predictCase3DNet(list(networks.values()), data, do_tta, cf.val_num_repeats,
+        cf.val_batch_size, cf.net_input_must_be_divisible_by, cf.val_min_size, device, cf.da_mirror_axes)
+
+    seg = np.argmax(softmax_pred, 0)
+
+    if postprocess:
+      seg = self.postprocessPrediction(seg)
+
+    return self.restoreSegmentationSize(seg, data_dict)
+
 
 #
 # HDBrainExtractionToolTest